@@ -7,9 +7,9 @@ Author:   James Nimmo
 """
 import asyncio
 import logging
-import socket
 import random
-from struct import pack
+import socket
+from collections import namedtuple
 
 from homeassistant.const import (CONF_DEVICES, CONF_HOST, CONF_NAME, CONF_PORT,
                                  CONF_TYPE, STATE_ON, STATE_OFF)
@@ -74,6 +74,13 @@ CONF_PROTOCOLS = [CONF_PROTOCOL_ARTNET,
 CONF_PORT_ARTNET = 6454
 CONF_PORT_KINET = 6038
 
+# Frames per second sent while transitions are running
+TRANSITION_FPS = 40
+
+# UDP socket tuning: room for a burst of frames, and low delay routing
+SOCKET_SEND_BUFFER_SIZE = 64 * 1024
+IPTOS_LOWDELAY = 0x10
+
 # Light types
 CONF_LIGHT_TYPE_DIMMER = 'dimmer'
 CONF_LIGHT_TYPE_DRGB = 'drgb'
@@ -153,6 +160,16 @@ COLOR_MAP[CONF_LIGHT_TYPE_RGBWD] = [255, 255, 255]
 COLOR_MAP[CONF_LIGHT_TYPE_SWITCH] = None
 COLOR_MAP[CONF_LIGHT_TYPE_CUSTOM_WHITE] = None
 
+# All of the above per light type, so a light resolves its type only once
+LightTypeDesc = namedtuple('LightTypeDesc',
+                           ['channel_count', 'features', 'default_color'])
+LIGHT_TYPE_MAP = {light_type: LightTypeDesc(CHANNEL_COUNT_MAP[light_type],
+                                             FEATURE_MAP[light_type],
+                                             COLOR_MAP[light_type])
+                  for light_type in CONF_LIGHT_TYPES}
+# Used for light types that are not in the maps
+DEFAULT_LIGHT_TYPE_DESC = LightTypeDesc(1, None, None)
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_HOST): cv.string,
     vol.Optional(CONF_UNIVERSE, default=0): cv.byte,
@@ -186,8 +203,7 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
 })
 
 
-@asyncio.coroutine
-def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
     host = config.get(CONF_HOST)
     universe = config.get(CONF_UNIVERSE)
     port = config.get(CONF_PORT)
@@ -202,13 +218,18 @@ def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
     if protocol == CONF_PROTOCOL_ARTNET:
         if not port:
             port = CONF_PORT_ARTNET
-        dmx_gateway = ArtNetGateway(host, universe, port, overall_default_level,
-                config[CONF_DMX_CHANNELS])
+        gateway_class = ArtNetGateway
     elif protocol == CONF_PROTOCOL_KINET:
         if not port:
             port = CONF_PORT_KINET
-        dmx_gateway = KiNetGateway(host, universe, port, overall_default_level,
-                config[CONF_DMX_CHANNELS])
+        gateway_class = KiNetGateway
+
+    # Let the event loop own the UDP socket so sending never blocks it
+    transport, _ = await hass.loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, remote_addr=(host, port))
+    dmx_gateway = gateway_class(transport, host, universe, port,
+                                overall_default_level,
+                                config[CONF_DMX_CHANNELS])
 
     lights = (DMXLight(light, dmx_gateway, send_levels_on_startup, default_light_type) for light in
               config[CONF_DEVICES])
@@ -229,11 +250,12 @@ class DMXLight(LightEntity):
         self._name = light.get(CONF_NAME, f"DMX Channel {self._channel}")
 
         self._type = light.get(CONF_TYPE, default_type)
+        light_type = LIGHT_TYPE_MAP.get(self._type, DEFAULT_LIGHT_TYPE_DESC)
 
         self._fade_time = light.get(CONF_TRANSITION)
         self._brightness = light.get(CONF_DEFAULT_LEVEL,
                                      dmx_gateway.default_level)
-        self._rgb = light.get(CONF_DEFAULT_COLOR, COLOR_MAP.get(self._type))
+        self._rgb = light.get(CONF_DEFAULT_COLOR, light_type.default_color)
         self._white_value = light.get(ATTR_WHITE_VALUE, 0)
         self._color_temp = int((self.min_mireds + self.max_mireds) / 2)
         self._channel_setup = light.get(CONF_CHANNEL_SETUP, '')
@@ -242,12 +264,11 @@ class DMXLight(LightEntity):
         if self._type == CONF_LIGHT_TYPE_CUSTOM_WHITE:
             self._channel_count = len(self._channel_setup)
         else:
-            self._channel_count = CHANNEL_COUNT_MAP.get(self._type, 1)
+            self._channel_count = light_type.channel_count
 
-        self._channels = [channel for channel in range(self._channel,
-                                                       self._channel +
-                                                       self._channel_count)]
-        self._features = FEATURE_MAP.get(self._type)
+        self._channels = tuple(range(self._channel,
+                                     self._channel + self._channel_count))
+        self._features = light_type.features
 
         # Brightness needs to be set to the maximum default RGB level, then
         # scale up the RGB values to what HA uses
@@ -261,11 +282,18 @@ class DMXLight(LightEntity):
         else:
             self._state = STATE_OFF
 
+        last_channel = self._channels[-1]
+        if last_channel > dmx_gateway.number_of_channels:
+            _LOGGER.warning("DMX light %s uses channels up to %i, but only %i "
+                            "DMX channels are sent; the rest are ignored",
+                            self._name, last_channel,
+                            dmx_gateway.number_of_channels)
+
         # Send default levels to the controller
         self._dmx_gateway.set_channels(self._channels, self.dmx_values if default_off == False else 0,
                                        send_immediately)
 
-        _LOGGER.debug(f"Intialized DMX light {self._name}")
+        _LOGGER.debug("Intialized DMX light %s", self._name)
 
     @property
     def name(self):
@@ -433,8 +461,7 @@ class DMXLight(LightEntity):
     def fade_time(self, value):
         self._fade_time = value
 
-    @asyncio.coroutine
-    def async_turn_on(self, **kwargs):
+    async def async_turn_on(self, **kwargs):
         """Instruct the light to turn on.
 
         Move to using one method on the DMX class to set/fade either a single
@@ -460,15 +487,17 @@ class DMXLight(LightEntity):
         if ATTR_COLOR_TEMP in kwargs:
             self._color_temp = kwargs[ATTR_COLOR_TEMP]
 
+        # Scale the colour to DMX levels once for this state change
+        dmx_values = self.dmx_values
+
         _LOGGER.debug("Setting light '%s' to %s with transition time %i",
-                      self._name, repr(self.dmx_values), transition)
+                      self._name, dmx_values, transition)
         asyncio.ensure_future(
             self._dmx_gateway.set_channels_async(
-                self._channels, self.dmx_values, transition=transition))
+                self._channels, dmx_values, transition=transition))
         self.async_schedule_update_ha_state()
 
-    @asyncio.coroutine
-    def async_turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Instruct the light to turn off.
 
         If a transition time has been specified in
@@ -492,11 +521,13 @@ class DMXGateway(object):
     Base class to keep track of the values of DMX channels.
     """
 
-    def __init__(self, host, universe, port, default_level, number_of_channels):
+    def __init__(self, transport, host, universe, port, default_level,
+                 number_of_channels):
         """
         Initialise a bank of channels, with a default value.
         """
 
+        self._transport = transport
         self._host = host
         self._universe = universe
         self._port = port
@@ -507,8 +538,27 @@ class DMXGateway(object):
         if number_of_channels % 2 != 0:
             self._number_of_channels += 1
 
+        # Tune the UDP socket owned by the transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                SOCKET_SEND_BUFFER_SIZE)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS,
+                                IPTOS_LOWDELAY)
+            except OSError as err:
+                _LOGGER.debug("Unable to tune DMX socket: %s", err)
+
         # Initialise the DMX channel array with the default values
-        self._channels = [self._default_level] * self._number_of_channels
+        self._channels = bytearray([self._default_level] *
+                                   self._number_of_channels)
+
+        # Transitions in progress, all advanced by a single ticker task
+        self._active_fades = []
+        self._ticker_task = None
+
+        # Whether channels have changed since the last frame was sent
+        self._dirty = False
 
     def send(self):
         """
@@ -520,57 +570,110 @@ class DMXGateway(object):
     def set_channels(self, channels, value, send_immediately=True):
         _last_command_ids[channels[0]] = random.randint(1, 1000000)
 
-        # Single value for standard channels, RGB channels will have 3 or more
-        value_arr = [value]
-        if type(value) is tuple or type(value) is list:
-            value_arr = value
-
-        for x, channel in enumerate(channels):
-            default_value = value_arr[min(x, len(value_arr) - 1)]
-            self._channels[channel-1] = int(default_value)
+        # The channels of a fixture are consecutive, so write them as a single
+        # block. Anything past the end of the universe is dropped rather than
+        # growing the channel array.
+        start = channels[0] - 1
+        count = min(len(channels), self._number_of_channels - start)
+        self._channels[start:start + count] = bytes(
+            to_dmx_level(target) for target in expand_values(value, count))
 
         if send_immediately:
-            self.send()
+            self._dirty = True
+            # A running ticker sends the change along with its next frame
+            if self._ticker_task is None:
+                self._flush()
+
+    async def set_channels_async(self, channels, value, transition=0,
+                                 send_immediately=True):
+        number_of_frames = int(transition * TRANSITION_FPS)
+
+        # A snap transition needs no frames, set the levels straight away
+        if number_of_frames <= 1:
+            self.set_channels(channels, value, send_immediately)
+            return
+
+        # Drop channels past the end of the universe, as set_channels does
+        count = min(len(channels), self._number_of_channels - channels[0] + 1)
+        if count <= 0:
+            return
+        channels = channels[:count]
 
-    @asyncio.coroutine
-    def set_channels_async(self, channels, value, transition=0, fps=40,
-                           send_immediately=True):
         _last_command_ids[channels[0]] = random.randint(1, 1000000)
-        currently_exec_cmd_id = _last_command_ids[channels[0]]
-        
-        original_values = self._channels[:]
-        # Minimum of one frame for a snap transition
-        number_of_frames = max(int(transition * fps), 1)
-
-        # Single value for standard channels, RGB channels will have 3 or more
-        value_arr = [value]
-        if type(value) is tuple or type(value) is list:
-            value_arr = value
-
-        for i in range(1, number_of_frames+1):
-            values_changed = False
 
-            for x, channel in enumerate(channels):
-                target_value = value_arr[min(x, len(value_arr) - 1)]
-                increment = (target_value -
-                             original_values[channel - 1])/(number_of_frames)
+        # Whole numbers within 0-255, so every frame can be interpolated with
+        # integers and always fits in the channel array
+        targets = [to_dmx_level(target)
+                   for target in expand_values(value, len(channels))]
 
-                next_value = int(round(
-                    original_values[channel - 1] + (increment * i)))
+        fade = _ActiveFade(channels, self._channels, targets,
+                           number_of_frames, send_immediately,
+                           asyncio.get_running_loop().create_future())
+        self._active_fades.append(fade)
 
-                if self._channels[channel - 1] != next_value:
-                    self._channels[channel - 1] = next_value
-                    values_changed = True
+        if self._ticker_task is None:
+            self._ticker_task = asyncio.ensure_future(self._run_ticker())
 
-            if values_changed and send_immediately:
-                self.send()
+        await fade.done
 
-            yield from asyncio.sleep(1. / fps)
+    async def _run_ticker(self):
+        """
+        Advance every transition in progress by one frame per tick, sending
+        at most one DMX frame per tick for all of them together.
+        """
+        try:
+            while self._active_fades:
+                for fade in list(self._active_fades):
+                    # Abort transition if new command has been sent
+                    if fade.aborted:
+                        _LOGGER.info("Transition aborted")
+                        self._finish_fade(fade)
+                        continue
+
+                    # A failing fade is handed back to its caller, the
+                    # other transitions carry on
+                    try:
+                        values_changed = fade.advance(self._channels)
+                    except Exception as err:
+                        self._finish_fade(fade, err)
+                        continue
+
+                    if values_changed and fade.send_immediately:
+                        self._dirty = True
+
+                    if fade.finished:
+                        self._finish_fade(fade)
+
+                self._flush()
+
+                await asyncio.sleep(1. / TRANSITION_FPS)
+
+            # Changes made during the final tick have not been sent yet
+            self._flush()
+        finally:
+            # Don't leave callers waiting on fades that will never advance
+            for fade in self._active_fades:
+                if not fade.done.done():
+                    fade.done.cancel()
+            self._active_fades.clear()
+            self._ticker_task = None
+
+    def _flush(self):
+        """
+        Send a frame if any channel has changed since the last one.
+        """
+        if self._dirty:
+            self._dirty = False
+            self.send()
 
-            # Abort transition if new command has been sent
-            if currently_exec_cmd_id != _last_command_ids[channels[0]]:
-                _LOGGER.info("Transition aborted")
-                break
+    def _finish_fade(self, fade, error=None):
+        self._active_fades.remove(fade)
+        if fade.done.done():
+            return
+        if error is not None:
+            fade.done.set_exception(error)
+        else:
+            fade.done.set_result(None)
 
     def get_channel_level(self, channel):
         """
@@ -582,69 +685,164 @@ class DMXGateway(object):
     def default_level(self):
         return self._default_level
 
+    @property
+    def number_of_channels(self):
+        return self._number_of_channels
+
+class _ActiveFade(object):
+    """
+    A transition in progress on a group of channels.
+    """
+
+    def __init__(self, channels, levels, targets,
+                 number_of_frames, send_immediately, done):
+        self.channels = channels
+        # Zero based positions in the channel array
+        self.indices = [channel - 1 for channel in channels]
+        # Only the channels being faded need their starting levels kept
+        self.original_values = bytes(levels[index] for index in self.indices)
+        self.targets = targets
+        self.number_of_frames = number_of_frames
+        self.send_immediately = send_immediately
+        self.done = done
+
+        self._command_id = _last_command_ids[channels[0]]
+        self._frame = 0
+
+    @property
+    def aborted(self):
+        """
+        Whether a newer command has been sent to these channels.
+        """
+        return self._command_id != _last_command_ids[self.channels[0]]
+
+    @property
+    def finished(self):
+        return self._frame >= self.number_of_frames
+
+    def advance(self, levels):
+        """
+        Write the next frame into the channel array.
+
+        Returns whether any of the channels changed value.
+        """
+        self._frame += 1
+        return fade_frame(levels, self.indices, self.original_values,
+                          self.targets, self._frame, self.number_of_frames)
+
 class ArtNetGateway(DMXGateway):
     """
     Interface with a ArtNet device
     """
 
-    def __init__(self, host, universe, port, default_level,
+    def __init__(self, transport, host, universe, port, default_level,
                  number_of_channels):
-        super().__init__(host, universe, port, default_level, number_of_channels)
-
-        # Initialise socket
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-
-        packet = bytearray()
-        packet.extend(map(ord, "Art-Net"))
-        packet.append(0x00)  # Null terminate Art-Net
-        packet.extend([0x00, 0x50])  # Opcode ArtDMX 0x5000 (Little endian)
-        packet.extend([0x00, 0x0e])  # Protocol version 14
-        packet.extend([0x00, 0x00])  # Sequence, Physical
-        packet.extend([self._universe, 0x00])  # Universe
-        packet.extend(pack('>h', self._number_of_channels))
-        self._base_packet = packet
+        super().__init__(transport, host, universe, port, default_level,
+                         number_of_channels)
+
+        self._base_packet = (
+            b"Art-Net\x00"  # Null terminated Art-Net
+            b"\x00\x50"  # Opcode ArtDMX 0x5000 (Little endian)
+            b"\x00\x0e"  # Protocol version 14
+            b"\x00\x00"  # Sequence, Physical
+            + bytes([self._universe, 0x00])  # Universe
+            + self._number_of_channels.to_bytes(2, 'big'))  # Length
+
+        # Every frame is sent from the same buffer, only the levels change
+        self._frame_buf = bytearray(self._base_packet +
+                                    bytes(self._number_of_channels))
+        self._payload_view = memoryview(self._frame_buf)[len(self._base_packet):]
 
     def send(self):
         """
         Send the current state of DMX values to the gateway via UDP packet.
         """
-        # Copy the base packet then add the channel array
-        packet = self._base_packet[:]
-        packet.extend(self._channels)
-        self._socket.sendto(packet, (self._host, self._port))
-        _LOGGER.debug(f"Sending Art-Net frame to {self._host}:{self._port}")
+        # Copy the channel array into the reused frame buffer
+        self._payload_view[:] = self._channels
+        self._transport.sendto(self._frame_buf)
+        _LOGGER.debug("Sending Art-Net frame to %s:%i", self._host, self._port)
 
 class KiNetGateway(DMXGateway):
     """
     Interface with a KiNet device
     """
 
-    def __init__(self, host, universe, port, default_level,
+    def __init__(self, transport, host, universe, port, default_level,
                  number_of_channels):
-        super().__init__(host, universe, port, default_level, number_of_channels)
+        super().__init__(transport, host, universe, port, default_level,
+                         number_of_channels)
 
-        # Initialise socket
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
+        self._base_packet = (
+            b"\x04\x01\xdc\x4a\x01\x00\x01\x01"  # Magic, version, type
+            b"\x00\x00\x00\x00"  # Sequence
+            b"\x00\x00\x00\x00"  # Port, padding, flags
+            b"\xff\xff\xff\xff"  # Timer
+            + bytes([self._universe]))  # Universe
 
-        packet = bytearray()
-        packet.extend(pack(">IHH", 0x0401dc4a, 0x0100, 0x0101)) # Magic, version, type
-        packet.extend(pack(">IBBHI", 0, 0, 0, 0, 0xffffffff)) # sequence, port, padding, flags, timer
-        packet.extend(pack("B", self._universe))  # Universe
-        self._base_packet = packet
+        # Every frame is sent from the same buffer, only the levels change
+        self._frame_buf = bytearray(self._base_packet +
+                                    bytes(self._number_of_channels))
+        self._payload_view = memoryview(self._frame_buf)[len(self._base_packet):]
 
     def send(self):
         """
         Send the current state of DMX values to the gateway via UDP packet.
         """
-        # Copy the base packet then add the channel array
-        packet = self._base_packet[:]
-        packet.extend(pack("512B", *self._channels))
-        self._socket.sendto(packet, (self._host, self._port))
-        _LOGGER.debug(f"Sending KiNet frame to {self._host}:{self._port}")
+        # Copy the channel array into the reused frame buffer
+        self._payload_view[:] = self._channels
+        self._transport.sendto(self._frame_buf)
+        _LOGGER.debug("Sending KiNet frame to %s:%i", self._host, self._port)
 
 def scale_rgb_to_brightness(rgb, brightness):
-    brightness_scale = (brightness / 255)
-    scaled_rgb = [round(rgb[0] * brightness_scale),
-                  round(rgb[1] * brightness_scale),
-                  round(rgb[2] * brightness_scale)]
+    red, green, blue = rgb[:3]
+    # Brightness derived from default_rgb is fractional, scale it as before
+    if not isinstance(brightness, int):
+        brightness_scale = (brightness / 255)
+        return [round(red * brightness_scale),
+                round(green * brightness_scale),
+                round(blue * brightness_scale)]
+
+    # Integer equivalent of round(value * brightness / 255)
+    scaled_rgb = [(red * brightness + 127) // 255,
+                  (green * brightness + 127) // 255,
+                  (blue * brightness + 127) // 255]
     return scaled_rgb
+
+def expand_values(value, count):
+    """
+    Return a value for each of count channels, repeating the last one given.
+    """
+    # Single value for standard channels, RGB channels will have 3 or more
+    value_arr = [value]
+    if type(value) is tuple or type(value) is list:
+        value_arr = value
+
+    last = len(value_arr) - 1
+    return [value_arr[min(x, last)] for x in range(count)]
+
+def to_dmx_level(value):
+    """
+    Round a value to the nearest valid DMX level between 0 and 255.
+    """
+    return min(max(int(round(value)), 0), 255)
+
+def fade_frame(levels, indices, original_values, targets, frame,
+               number_of_frames):
+    """
+    Write the levels of one frame of a fade into the channel array.
+
+    Returns whether any of the channels changed value.
+    """
+    remaining = number_of_frames - frame
+    half = number_of_frames // 2
+    values_changed = False
+    for index, original, target in zip(indices, original_values, targets):
+        # Rounded integer interpolation, always between original and target
+        next_value = (original * remaining +
+                      target * frame + half) // number_of_frames
+
+        if levels[index] != next_value:
+            levels[index] = next_value
+            values_changed = True
+
+    return values_changed